@@ -64,7 +64,6 @@ metadata = dict(
     packages=find_packages("./src"),
     install_requires=[
         'boto3',
-        'psutil',
         'Click'
     ],
     entry_points = {
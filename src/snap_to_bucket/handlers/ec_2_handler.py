@@ -10,17 +10,26 @@ __author__ = "Siemens AG"
 
 import os
 import sys
-import http
 import json
 import math
 import urllib.request
 from datetime import datetime
 
 import boto3
+from botocore.config import Config
 
 AWS_META_URL = "http://169.254.169.254/latest/dynamic/instance-identity/document/"
 AWS_TOKEN_URL = "http://169.254.169.254/latest/api/token"
 
+CLIENT_CONFIG = Config(
+    max_pool_connections=32,
+    retries={
+        "mode": "adaptive",
+        "max_attempts": 10
+    },
+    tcp_keepalive=True
+)
+
 
 class Ec2Handler:
     """
@@ -33,8 +42,24 @@ class Ec2Handler:
     :ivar ec2client: EC2 client from boto3
     :ivar iops: IOPS for supported volumes
     :ivar throughput: Throughput for supported volumes
+    :ivar WAITER_CONFIG: Polling delay and attempt cap for EC2 waiters on
+        the provisioning path (create/attach)
+    :ivar TEARDOWN_WAITER_CONFIG: Slower polling for detach/delete, which
+        are off the critical path and should not eat into the API budget
     """
 
+    WAITER_CONFIG = {
+        "Delay": 1,
+        "MaxAttempts": 300
+    }
+
+    TEARDOWN_WAITER_CONFIG = {
+        "Delay": 3,
+        "MaxAttempts": 100
+    }
+
+    __instance_info_cache = None
+
     def __init__(self, tag="snap-to-bucket", volume_type="gp2", verbose=0,
                  iops=None, throughput=None):
         """
@@ -60,50 +85,48 @@ class Ec2Handler:
         self.verbose = verbose
         self.iops = iops
         self.throughput = throughput
-        try:
-            response = urllib.request.urlopen(AWS_META_URL)
-        except urllib.error.HTTPError as ex:
-            if ex.code == http.client.UNAUTHORIZED:
+        if Ec2Handler.__instance_info_cache is None:
+            try:
                 response = self.get_info_from_imds2()
-            else:
-                raise ex
-        except urllib.error.URLError as ex:
-            print("Script needs to run on an EC2 instance!", file=sys.stderr)
-            raise ex
-        self.instance_info = json.loads(response.read().decode("UTF-8").strip())
-        response.close()
+            except urllib.error.URLError:
+                if self.verbose > 0:
+                    print("IMDSv2 not reachable. Trying with IMDSv1.")
+                try:
+                    response = urllib.request.urlopen(AWS_META_URL)
+                except urllib.error.URLError as ex:
+                    print("Script needs to run on an EC2 instance!",
+                          file=sys.stderr)
+                    raise ex
+            Ec2Handler.__instance_info_cache = json.loads(
+                response.read().decode("UTF-8").strip())
+            response.close()
+        self.instance_info = Ec2Handler.__instance_info_cache
         if self.verbose > 0:
             print("Current instance is '" + self.instance_info["instanceId"] +
                   "'")
         os.environ["AWS_DEFAULT_REGION"] = self.instance_info["region"]
-        self.ec2client = boto3.client("ec2")
+        self.ec2client = boto3.client("ec2", config=CLIENT_CONFIG)
 
     def get_info_from_imds2(self):
         """
-        Try to get the instance from IMDSv2.
+        Get the instance info from IMDSv2.
 
         The function gets token from AWS and use it to authenticate call to
-        IMDSv2.
+        IMDSv2. This is the primary path since hardened instances accept only
+        token-based calls; the caller falls back to IMDSv1 on failure.
 
         :return: Response from AWS meta data url
         :raises urllib.error.URLError: If call fails
         """
-        try:
-            if self.verbose > 0:
-                print("Unable to get instance info. Trying with IMDSv2.")
-            req = urllib.request.Request(AWS_TOKEN_URL,
-                headers={"X-aws-ec2-metadata-token-ttl-seconds": 60},
-                method="PUT")
-            response = urllib.request.urlopen(req)
-            token = response.read().decode("UTF-8").strip()
-            response.close()
-            req = urllib.request.Request(AWS_META_URL,
-                headers={"X-aws-ec2-metadata-token": token})
-            toreturn = urllib.request.urlopen(req)
-        except urllib.error.URLError as ex:
-            print("Script needs to run on an EC2 instance!", file=sys.stderr)
-            raise ex
-        return toreturn
+        req = urllib.request.Request(AWS_TOKEN_URL,
+            headers={"X-aws-ec2-metadata-token-ttl-seconds": 21600},
+            method="PUT")
+        response = urllib.request.urlopen(req)
+        token = response.read().decode("UTF-8").strip()
+        response.close()
+        req = urllib.request.Request(AWS_META_URL,
+            headers={"X-aws-ec2-metadata-token": token})
+        return urllib.request.urlopen(req)
 
     def get_snapshots(self):
         """
@@ -114,8 +137,8 @@ class Ec2Handler:
         :return: List of snapshots dictionaries with id and name
         :rtype: list()
         """
-        responses = []
-        responses.append(self.ec2client.describe_snapshots(
+        paginator = self.ec2client.get_paginator("describe_snapshots")
+        pages = paginator.paginate(
             Filters=[
                 {
                     "Name": "tag:" + self.tag,
@@ -124,30 +147,18 @@ class Ec2Handler:
                     ]
                 }
             ]
-        ))
-        while responses[-1].get("NextToken", None) is not None:
-            responses.append(self.ec2client.describe_snapshots(
-                Filters=[
-                    {
-                        "Name": "tag:" + self.tag,
-                        "Values": [
-                            "migrate"
-                        ]
-                    }
-                ],
-                NextToken=responses[-1]["NextToken"]
-            ))
+        )
         snapshots = []
-        for response in responses:
-            for snap in response["Snapshots"]:
+        for page in pages:
+            for snap in page["Snapshots"]:
                 snapshot = {}
                 snapshot["id"] = snap["SnapshotId"]
                 snapshot["created"] = snap["StartTime"]
                 snapshot["volumesize"] = snap["VolumeSize"]
-                for tag in snap["Tags"]:
-                    if tag["Key"].lower() == "name":
-                        snapshot["name"] = tag["Value"]
-                        break
+                tags = {tag["Key"].lower(): tag["Value"]
+                        for tag in snap.get("Tags", [])}
+                if "name" in tags:
+                    snapshot["name"] = tags["name"]
                 snapshots.append(snapshot)
         if self.verbose > 0:
             print("Found " + str(len(snapshots)) + " snapshots")
@@ -272,21 +283,21 @@ class Ec2Handler:
             raise ex
         return None
 
-    def __volume_is_ready(self, volumeid):
+    def __volume_is_ready(self, volumeid, waiter_config=None):
         """
         Wait till volume is ready
 
         :param volumeid: Volume id to wait for
         :type volumeid: str
+        :param waiter_config: Polling configuration (defaults to the
+            provisioning-path WAITER_CONFIG)
+        :type waiter_config: dict()
 
         :raises botocore.exceptions.WaiterError: If the volume creation failed
         """
         self.ec2client.get_waiter("volume_available").wait(
             VolumeIds=[volumeid],
-            WaiterConfig={
-                "Delay": 10,
-                "MaxAttempts": 50
-            }
+            WaiterConfig=waiter_config or self.WAITER_CONFIG
         )
         return True
 
@@ -300,7 +311,8 @@ class Ec2Handler:
         :raises botocore.exceptions.WaiterError: If the volume attachment failed
         """
         self.ec2client.get_waiter("volume_in_use").wait(
-            VolumeIds=[volumeid]
+            VolumeIds=[volumeid],
+            WaiterConfig=self.WAITER_CONFIG
         )
         return True
 
@@ -314,23 +326,27 @@ class Ec2Handler:
         :raises botocore.exceptions.WaiterError: If the volume deletion failed
         """
         self.ec2client.get_waiter("volume_deleted").wait(
-            VolumeIds=[volumeid]
+            VolumeIds=[volumeid],
+            WaiterConfig=self.TEARDOWN_WAITER_CONFIG
         )
         return True
 
-    def attach_volume(self, volumeid):
+    def attach_volume(self, volumeid, device="/dev/sdk"):
         """
         Attach given volume to current instance
 
         :param volumeid: Volume id to attach
         :type volumeid: str
+        :param device: Device name to attach the volume at (must differ for
+            volumes attached at the same time)
+        :type device: str
 
         :raises botocore.exceptions.WaiterError: If the volume attachment failed,
             try to delete it and raise exception
         """
         try:
             self.ec2client.attach_volume(
-                Device="/dev/sdk",
+                Device=device,
                 InstanceId=self.instance_info["instanceId"],
                 VolumeId=volumeid
             )
@@ -371,7 +387,7 @@ class Ec2Handler:
         if self.verbose > 1:
             print(f"Detaching volume '{volumeid}' from instance '" +
                   self.instance_info["instanceId"] + "'")
-        if self.__volume_is_ready(volumeid):
+        if self.__volume_is_ready(volumeid, self.TEARDOWN_WAITER_CONFIG):
             if self.verbose > 2:
                 print(f"Volume '{volumeid}' detached from '" +
                       self.instance_info["instanceId"] + "'")
@@ -11,12 +11,36 @@ __author__ = "Siemens AG"
 import os
 import re
 import sys
+import glob
 import time
 import json
+import ctypes
+import errno
+import fcntl
+import shlex
 import shutil
 import subprocess
 from subprocess import PIPE, Popen
 
+try:
+    LIBC = ctypes.CDLL("libc.so.6", use_errno=True)
+except OSError:
+    LIBC = None
+
+try:
+    LIBBLKID = ctypes.CDLL("libblkid.so.1", use_errno=True)
+    LIBBLKID.blkid_get_tag_value.restype = ctypes.c_char_p
+    LIBBLKID.blkid_get_tag_value.argtypes = [ctypes.c_void_p, ctypes.c_char_p,
+                                             ctypes.c_char_p]
+except (OSError, AttributeError):
+    LIBBLKID = None
+
+MS_BIND = 4096
+
+FSTAB_PATTERN = re.compile(
+    r"((?:UUID)|(?:LABEL))=([0-9a-z\-]+)\s+((?:\/boot)|(?:\/))\s+(ext(?:[2-4]))",
+    re.RegexFlag.IGNORECASE)
+
 
 class FsHandler:
     """
@@ -25,8 +49,17 @@ class FsHandler:
     :ivar mount_point: Mount point to be used for devices
     :ivar verbose: Verbosity level (0-3)
     :ivar device: The device to be mounted
+    :ivar PIPE_CAPACITY: Capacity (in bytes) requested for the untar pipe
+    :ivar LSBLK_CACHE_TTL: How long (in seconds) the lsblk output is cached
     """
 
+    PIPE_CAPACITY = 1 << 20
+    LSBLK_CACHE_TTL = 2.0
+
+    __lsblk_cache = None
+    __lsblk_time = 0.0
+    __settled_serial = None
+
     def __init__(self, mount_point, verbose=0):
         """
         Initializer for the class attributes.
@@ -42,15 +75,67 @@ class FsHandler:
         self.device = None
 
     @staticmethod
-    def wait_for_device_settle():
+    def wait_for_device_settle(volumeid=None):
         """
         Wait for device to settle
 
-        Calls ``partprobe`` and ``udevadm settle``
+        Calls ``partprobe`` and ``udevadm settle``, which returns as soon as
+        the udev event queue drains. If a volume id is given, poll for its
+        device node under ``/dev/disk/by-id`` (50 ms steps, 5 s cap) instead
+        of sleeping a fixed five seconds; the node typically shows up well
+        under a second after the queue drains.
+
+        Settling is idempotent per volume: when the named volume was already
+        settled on (e.g. ``mount_volume`` right after ``prepare_volume``),
+        the partprobe/settle forks are skipped entirely.
+
+        :param volumeid: Volume expected to appear (None to just sleep)
+        :type volumeid: string
         """
+        volume_serial = None
+        if volumeid is not None:
+            volume_serial = volumeid.replace("-", "")
+            if volume_serial == FsHandler.__settled_serial:
+                return
         subprocess.call(["partprobe"])
-        subprocess.call(["udevadm", "settle"])
-        time.sleep(5)
+        subprocess.call(["udevadm", "settle", "--timeout=5"])
+        FsHandler.__lsblk_cache = None
+        FsHandler.__settled_serial = None
+        if volumeid is None:
+            time.sleep(5)
+            return
+        deadline = time.monotonic() + 5.0
+        while time.monotonic() < deadline:
+            if glob.glob(f"/dev/disk/by-id/*{volume_serial}*"):
+                FsHandler.__settled_serial = volume_serial
+                break
+            time.sleep(0.05)
+
+    @classmethod
+    def __get_block_devices(cls):
+        """
+        Get the block-device tree from lsblk
+
+        The parsed JSON is cached for a short interval so back-to-back device
+        lookups (``prepare_volume`` alone performs two) share one ``lsblk``
+        invocation, and indexed by serial so lookups do not rescan the whole
+        device list. The cache is dropped by :func:`wait_for_device_settle`.
+
+        :return: Mapping of device serial to its lsblk entry
+        :rtype: dict()
+        """
+        now = time.monotonic()
+        if cls.__lsblk_cache is None or \
+                now - cls.__lsblk_time > cls.LSBLK_CACHE_TTL:
+            result = subprocess.run(["lsblk", "--json", "--output",
+                    "NAME,SERIAL,MOUNTPOINT"], stdout=PIPE, check=False,
+                    text=True, encoding="UTF-8").stdout.strip()
+            devices = json.loads(result)
+            cls.__lsblk_cache = {device["serial"]: device
+                                 for device in devices["blockdevices"]
+                                 if device.get("serial")}
+            cls.__lsblk_time = now
+        return cls.__lsblk_cache
 
     def __get_mbr_device_name(self, volumeid):
         """
@@ -68,22 +153,15 @@ class FsHandler:
 
         :raises Exception: If none devices can be found
         """
-        with Popen(["lsblk", "--json", "--output",
-                "NAME,SERIAL,MOUNTPOINT"], stdout=PIPE) as lsblk_process:
-            result = lsblk_process.communicate()[0].decode("UTF-8").strip()
-        devices = json.loads(result)
         blk_device = None
-        volume_serial = volumeid.replace("-", "")
-        for device in devices["blockdevices"]:
-            if device["serial"] == volume_serial:
-                if "children" in device:
-                    for child in device["children"]:
-                        if child["mountpoint"] == self.mount_point:
-                            blk_device = "/dev/" + device["name"]
-                            break
-                if blk_device is None:
+        device = self.__get_block_devices().get(volumeid.replace("-", ""))
+        if device is not None:
+            for child in device.get("children", []):
+                if child["mountpoint"] == self.mount_point:
                     blk_device = "/dev/" + device["name"]
-                break
+                    break
+            if blk_device is None:
+                blk_device = "/dev/" + device["name"]
         if blk_device is None:
             raise Exception
         return blk_device
@@ -101,22 +179,15 @@ class FsHandler:
 
         :raises Exception: If none mountable devices can be found
         """
-        with Popen(["lsblk", "--json", "--output",
-                "NAME,SERIAL,MOUNTPOINT"], stdout=PIPE) as lsblk_process:
-            result = lsblk_process.communicate()[0].decode("UTF-8").strip()
-        devices = json.loads(result)
         blk_device = None
-        volume_serial = volumeid.replace("-", "")
-        for device in devices["blockdevices"]:
-            if device["serial"] == volume_serial:
-                if "children" in device:
-                    for child in device["children"]:
-                        if child["mountpoint"] is None:
-                            blk_device = "/dev/" + child["name"]
-                            break
-                if blk_device is None:
-                    blk_device = "/dev/" + device["name"]
-                break
+        device = self.__get_block_devices().get(volumeid.replace("-", ""))
+        if device is not None:
+            for child in device.get("children", []):
+                if child["mountpoint"] is None:
+                    blk_device = "/dev/" + child["name"]
+                    break
+            if blk_device is None:
+                blk_device = "/dev/" + device["name"]
         if blk_device is None:
             raise Exception
         self.device = blk_device
@@ -128,7 +199,7 @@ class FsHandler:
         :param volumeid: Volume to be mounted
         :type volumeid: string
         """
-        FsHandler.wait_for_device_settle()
+        FsHandler.wait_for_device_settle(volumeid)
         try:
             self.__update_device_name(volumeid)
         except Exception as ex:
@@ -145,7 +216,7 @@ class FsHandler:
         """
         if self.verbose > 1:
             print(f"Unmounting device at '{self.mount_point}'")
-        subprocess.call(["umount", self.mount_point])
+        self.__syscall_umount(self.mount_point)
 
     def prepare_volume(self, volume_id, boot):
         """
@@ -154,6 +225,12 @@ class FsHandler:
         1. Create a DOS partition table
         2. Create a primary partition and mark it as bootable (if selected)
 
+        The second settle round trip is avoided: the primary partition of a
+        fresh DOS disk has a deterministic name, so after ``sfdisk`` only an
+        event-driven ``udevadm trigger --settle`` on the disk plus a short
+        poll for the partition node is needed instead of another sleep and
+        lsblk parse.
+
         **NOTE:** Call this function before mounting a blank disk
 
         :param volume_id: Volume to be prepared
@@ -161,7 +238,7 @@ class FsHandler:
         :param boot: Make the primary partition bootable
         :type boot: boolean
         """
-        self.wait_for_device_settle()
+        self.wait_for_device_settle(volume_id)
         if boot:
             bootable = ", bootable"
         else:
@@ -169,14 +246,77 @@ class FsHandler:
         self.__update_device_name(volume_id)
         if self.verbose > 2:
             print(f"Partitioning device {self.device}")
-        with Popen(["sfdisk", self.device], stdin=PIPE) as disk_process:
-            disk_process.communicate(input=str.encode("label: dos\ntype=83" + bootable + "\n"))
-        self.wait_for_device_settle()
-        self.__update_device_name(volume_id)
+        subprocess.run(["sfdisk", self.device],
+                       input="label: dos\ntype=83" + bootable + "\n",
+                       text=True, encoding="UTF-8", check=False)
+        subprocess.call(["udevadm", "trigger", "--settle", "--action=change",
+                         self.device])
+        FsHandler.__lsblk_cache = None
+        self.device = FsHandler.__get_partition_name(self.device)
+        deadline = time.monotonic() + 5.0
+        while not os.path.exists(self.device) and time.monotonic() < deadline:
+            time.sleep(0.05)
         if self.verbose > 2:
             print(f"Formating device {self.device} with ext4")
         subprocess.call(["mke2fs", "-t", "ext4", self.device])
 
+    @staticmethod
+    def __get_partition_name(device):
+        """
+        Derive the node of the first partition of a freshly partitioned disk
+
+        Devices whose name ends in a digit (nvme, loop) get a ``p`` between
+        disk name and partition number.
+
+        :param device: Device node of the whole disk
+        :type device: string
+
+        :return: Device node of the first partition
+        :rtype: string
+        """
+        if device[-1].isdigit():
+            return device + "p1"
+        return device + "1"
+
+    def get_untar_stream(self, gzip=False):
+        """
+        Get the writable end of the untar pipe, creating the untar process if
+        it does not exist.
+
+        Allows callers (like the S3 downloader) to stream tar data directly
+        into ``tar`` without staging it on the local disk first.
+
+        :param gzip: True if the stream is gzip compressed
+        :type gzip: boolean
+
+        :return: stdin of the untar process
+        :rtype: file object
+        """
+        if self.untar_process is None:
+            tar_options = ["tar", "--extract", "--directory", self.mount_point,
+                           "--preserve-permissions", "--preserve-order",
+                           "--blocking-factor=1024"]
+            if gzip:
+                tar_options.extend(FsHandler.__decompress_options())
+            self.untar_process = Popen(tar_options, stdin=PIPE)
+        return self.untar_process.stdin
+
+    @staticmethod
+    def __decompress_options():
+        """
+        Get the tar options to decompress a gzipped archive
+
+        Prefers ``pigz``, which spreads decompression over all cores and
+        turns a CPU-bound untar back into an I/O-bound one; falls back to
+        tar's single-threaded ``--gzip`` when pigz is not installed.
+
+        :return: Options to append to the tar command line
+        :rtype: list()
+        """
+        if shutil.which("pigz") is not None:
+            return ["--use-compress-program", "pigz -d"]
+        return ["--gzip"]
+
     def untar(self, tar_location):
         """
         Start untar process
@@ -189,17 +329,71 @@ class FsHandler:
         :type tar_location: string
         """
         print(f"Untaring file '{tar_location}' to '{self.mount_point}'")
-        if self.untar_process is None:
-            tar_options = ["tar", "--extract", "--directory", self.mount_point,
-                           "--preserve-permissions", "--preserve-order"]
-            if ".tar.gz" in tar_location:
-                tar_options.append("--gzip")
-            self.untar_process = Popen(tar_options, stdin=PIPE)
+        self.get_untar_stream(".tar.gz" in tar_location)
         with open(tar_location, "rb") as temp_file_obj:
-            shutil.copyfileobj(temp_file_obj, self.untar_process.stdin)
+            self.__pipe_to_tar(temp_file_obj)
         self.untar_process.stdin.flush()
         os.unlink(tar_location)
 
+    def __pipe_to_tar(self, temp_file_obj):
+        """
+        Send an opened tar file to stdin of the untar process.
+
+        The destination is always a pipe, so the data is moved with zero-copy
+        ``os.splice`` (falling back to ``os.sendfile``), keeping the payload in
+        kernel buffers instead of copying every block through user space. The
+        pipe capacity is enlarged first so the batches are large. On platforms
+        without either syscall, fall back to ``shutil.copyfileobj``.
+
+        The kernel is told the read is sequential up front and, once done,
+        that the pages are not needed again (the file gets unlinked right
+        after), so multi-GB archives do not thrash the page cache.
+
+        :param temp_file_obj: Opened tar file to be piped
+        :type temp_file_obj: file object
+        """
+        src_fd = temp_file_obj.fileno()
+        dst_fd = self.untar_process.stdin.fileno()
+        try:
+            fcntl.fcntl(dst_fd, fcntl.F_SETPIPE_SZ, FsHandler.PIPE_CAPACITY)
+        except (AttributeError, OSError):
+            pass  # default pipe capacity works, just with smaller batches
+        FsHandler.__fadvise(src_fd, os.POSIX_FADV_SEQUENTIAL)
+        self.untar_process.stdin.flush()
+        try:
+            try:
+                while os.splice(src_fd, dst_fd, FsHandler.PIPE_CAPACITY,
+                                flags=os.SPLICE_F_MOVE) > 0:
+                    pass
+                return
+            except (AttributeError, OSError) as ex:
+                if isinstance(ex, OSError) and \
+                        ex.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise ex
+            try:
+                while os.sendfile(dst_fd, src_fd, None,
+                                  FsHandler.PIPE_CAPACITY) > 0:
+                    pass
+            except OSError:
+                shutil.copyfileobj(temp_file_obj, self.untar_process.stdin)
+        finally:
+            FsHandler.__fadvise(src_fd, os.POSIX_FADV_DONTNEED)
+
+    @staticmethod
+    def __fadvise(src_fd, advice):
+        """
+        Pass an fadvise hint for the file, ignoring unsupported platforms
+
+        :param src_fd: File descriptor to advise on
+        :type src_fd: integer
+        :param advice: One of the ``os.POSIX_FADV_*`` constants
+        :type advice: integer
+        """
+        try:
+            os.posix_fadvise(src_fd, 0, 0, advice)
+        except (AttributeError, OSError):
+            pass
+
     def untar_single_file(self, tar_location):
         """
         Start untar process for a single part tars
@@ -214,15 +408,17 @@ class FsHandler:
         """
         print(f"Untaring file '{tar_location}' to '{self.mount_point}'")
         tar_options = ["tar", "--extract", "--directory", self.mount_point,
-                       "--preserve-permissions", "--preserve-order"]
+                       "--preserve-permissions", "--preserve-order",
+                       "--blocking-factor=1024"]
         if ".tar.gz" in tar_location:
-            tar_options.append("--gzip")
+            tar_options.extend(FsHandler.__decompress_options())
         tar_options.extend(["--file", tar_location])
-        with Popen(tar_options, stdout=PIPE, stderr=PIPE) as untar_process:
+        with Popen(tar_options, stdout=PIPE, stderr=PIPE, text=True,
+                   encoding="UTF-8") as untar_process:
             response = untar_process.communicate()
             if untar_process.returncode != 0:
-                output = response[0].decode("UTF-8").strip()
-                error = response[1].decode("UTF-8").strip()
+                output = response[0].strip()
+                error = response[1].strip()
                 print(f"Untar failed: {output}\n{error}.", file=sys.stderr)
                 raise Exception("Tar failed")
         os.unlink(tar_location)
@@ -236,41 +432,78 @@ class FsHandler:
         if returncode != 0:
             print(f"Untar returned: {returncode}", file=sys.stderr)
 
+    @staticmethod
+    def __bind_mount(source, target):
+        """
+        Bind mount source at target with the mount(2) syscall
+
+        Spawning ``/bin/mount`` costs a fork/exec and an fstab reparse per
+        call; the syscall does the same work in one kernel entry. Falls back
+        to ``/bin/mount`` where libc can't be loaded.
+
+        :param source: Folder to be bind mounted
+        :type source: string
+        :param target: Where to mount the folder
+        :type target: string
+        """
+        if LIBC is None:
+            subprocess.call(["mount", "--bind", source, target])
+            return
+        if LIBC.mount(source.encode(), target.encode(), None, MS_BIND,
+                      None) != 0:
+            err = ctypes.get_errno()
+            print(f"Failed to bind mount '{source}' at '{target}': " +
+                  os.strerror(err), file=sys.stderr)
+
+    @staticmethod
+    def __syscall_umount(target):
+        """
+        Unmount target with the umount2(2) syscall
+
+        Falls back to ``/bin/umount`` where libc can't be loaded.
+
+        :param target: Mount point to be unmounted
+        :type target: string
+        """
+        if LIBC is None:
+            subprocess.call(["umount", target])
+            return
+        if LIBC.umount2(target.encode(), 0) != 0:
+            err = ctypes.get_errno()
+            print(f"Failed to unmount '{target}': " + os.strerror(err),
+                  file=sys.stderr)
+
     def mount_required_folders(self):
         """
         Mount the required folders for chroot
         """
         for loc in ["/sys", "/proc", "/run", "/dev"]:
-            subprocess.call(["mount", "--bind", loc, self.mount_point + loc])
+            self.__bind_mount(loc, self.mount_point + loc)
 
     def unmount_required_folders(self):
         """
         Unmount the required folders for chroot
         """
         for loc in ["/sys", "/proc", "/run", "/dev"]:
-            subprocess.call(["umount", self.mount_point + loc])
+            self.__syscall_umount(self.mount_point + loc)
 
     def update_grub(self, volumeid):
         """
         Update the grub settings for the disk
 
-        Chroot to the freshly tared location and update the grub.
+        Chroot to the freshly tared location and update the grub. Both
+        commands run inside a single ``chroot`` invocation, sharing one shell
+        fork and leaving the cwd and root of this process untouched (the old
+        ``os.chroot`` round trip risked leaking the saved root fd on error).
 
         :param volumeid: The volume to search
         :type volumeid: string
         """
         print(f"ChRooting to {self.mount_point} to fix grub")
         mbr_device = self.__get_mbr_device_name(volumeid)
-        real_root = os.open("/", os.O_RDONLY)
-        current_dir = os.getcwd()
-        os.chdir(self.mount_point)
-        os.chroot(self.mount_point)
-        subprocess.call(["grub-install", mbr_device])
-        subprocess.call(["update-grub"])
-        os.fchdir(real_root)
-        os.chroot(".")
-        os.chdir(current_dir)
-        os.close(real_root)
+        subprocess.call(["chroot", self.mount_point, "/bin/sh", "-c",
+                         "grub-install " + shlex.quote(mbr_device) +
+                         " && update-grub"])
 
     def update_fstab(self):
         """
@@ -279,34 +512,35 @@ class FsHandler:
         Update the LABEL of volume or UUID in fstab
         """
         with open(f"{self.mount_point}/etc/fstab", "r", encoding="UTF-8") as fstab_file:
-            fstab = fstab_file.readline()
-        fstab_pattern = r"((?:UUID)|(?:LABEL))=([0-9a-z\-]+)\s+((?:\/boot)|(?:\/))\s+(ext(?:[2-4]))"
-        results = re.findall(fstab_pattern, fstab, re.RegexFlag.IGNORECASE)
-        if len(results) < 1:
+            fstab = fstab_file.read()
+        results = FSTAB_PATTERN.findall(fstab)
+        # the pattern matches /boot entries too; only the root entry gets
+        # the new partition's identifier
+        root_entry = next((r for r in results if r[2] == "/"), None)
+        if root_entry is None:
             raise Exception("Unable to understand fstab")
-        if results[0][0].lower() == "uuid":
+        if root_entry[0].lower() == "uuid":
             if self.verbose > 1:
                 print("The old snapshot was mounted using UUID=" +
-                      results[0][1])
-            with Popen(["blkid", "--output", "export",
-                    self.device], stdout=PIPE) as blkid_process:
-                blkid_response = blkid_process.communicate()[0].decode("UTF-8").strip()
-            blkid_pattern = r"^UUID=([0-9a-z\-]+)$"
-            blkid_uuid = re.findall(blkid_pattern, blkid_response,
-                                    re.RegexFlag.IGNORECASE | re.RegexFlag.MULTILINE)[0]
+                      root_entry[1])
+            blkid_uuid = self.__get_device_uuid()
             if self.verbose > 1:
                 print("New UUID of volume=" + blkid_uuid)
-            new_fstab = fstab.replace(results[0][1], blkid_uuid)
+            new_fstab = fstab.replace(root_entry[1], blkid_uuid)
             with open(f"{self.mount_point}/etc/fstab", "w", encoding="UTF-8") as fstab_file:
                 fstab_file.write(new_fstab)
-        elif results[0][0].lower() == "label":
-            label = results[0][1]
+        elif root_entry[0].lower() == "label":
+            label = root_entry[1]
             if self.verbose > 1:
                 print(f"The old snapshot was mounted using LABEL={label}")
             subprocess.call(["e2label", self.device, label])
-            time.sleep(1)
-            with Popen(["e2label", self.device], stdout=PIPE) as e2label_process:
-                response = e2label_process.communicate()[0].decode("UTF-8").strip()
+            deadline = time.monotonic() + 1.0
+            delay = 0.01
+            response = self.__read_e2label()
+            while response != label and time.monotonic() < deadline:
+                time.sleep(delay)
+                delay = min(delay * 2, 0.1)
+                response = self.__read_e2label()
             if response != label:
                 raise Exception("Unable to change the volume label to " +
                                 f"'{label}'")
@@ -315,19 +549,59 @@ class FsHandler:
         else:
             raise Exception("Unable to understand fstab")
 
-    def get_mounted_disc_size(self):
+    def __read_e2label(self):
+        """
+        Read back the current label of the device
+
+        Used to verify a label change instead of sleeping a fixed second; the
+        readback is polled with backoff and typically succeeds within a few
+        tens of milliseconds.
+
+        :return: Current label of the device
+        :rtype: string
+        """
+        return subprocess.run(["e2label", self.device], stdout=PIPE,
+                              check=False, text=True,
+                              encoding="UTF-8").stdout.strip()
+
+    def __get_device_uuid(self):
+        """
+        Get the filesystem UUID of the current device
+
+        Asks libblkid directly (a library call returning in microseconds)
+        and only falls back to forking the ``blkid`` binary where the library
+        can't be loaded. The fallback asks for the bare value, so no output
+        parsing is needed either way.
+
+        :return: UUID of the device
+        :rtype: string
+        """
+        if LIBBLKID is not None:
+            uuid = LIBBLKID.blkid_get_tag_value(None, b"UUID",
+                                                self.device.encode())
+            if uuid:
+                return uuid.decode("UTF-8")
+        return subprocess.run(["blkid", "-s", "UUID", "-o", "value",
+                self.device], stdout=PIPE, check=False, text=True,
+                encoding="UTF-8").stdout.strip()
+
+    def get_mounted_disc_size(self, sync=False):
         """
         Get the size of mounted partition
 
-        Uses ``df`` to get the size of partition. This makes it less accurate
-        but faster than using ``du``.
+        Uses ``os.statvfs`` to get the size of partition with a single
+        syscall. This makes it less accurate but faster than using ``du``.
+        The upload path sizes a freshly mounted snapshot volume with no dirty
+        pages of our own, so the flush ``df --sync`` used to force is skipped
+        unless a caller asks for it.
+
+        :param sync: Flush dirty buffers before reading the figures
+        :type sync: boolean
 
         :return: Size of the mounted partition in bytes
         :rtype: int
         """
-        retval = 0
-        with Popen(["/bin/df", "--sync", "-k", "--local", "--output=used",
-                self.mount_point], stdout=PIPE) as df_process:
-            retval = int(
-                (df_process.communicate()[0].decode("UTF-8").strip().split("\n"))[1]) * 1024
-        return retval
+        if sync:
+            os.sync()
+        stat = os.statvfs(self.mount_point)
+        return (stat.f_blocks - stat.f_bfree) * stat.f_frsize
@@ -8,39 +8,75 @@ SPDX-License-Identifier: MIT
 """
 __author__ = "Siemens AG"
 
-import gc
 import os
 import sys
+import math
 import time
 import base64
+import random
+import shutil
 import hashlib
 import threading
 from datetime import datetime
 from subprocess import PIPE, Popen
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
-import psutil
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
+#: Pool sized for the upload workers and download threads together, with
+#: keepalive so long-lived connections survive idle spells between parts.
+#: Payload signing is off (UNSIGNED-PAYLOAD over HTTPS) so part bodies are
+#: not SHA256-scanned a second time; Content-MD5 still covers integrity.
+CLIENT_CONFIG = Config(max_pool_connections=32,
+                       retries={"mode": "adaptive", "max_attempts": 10},
+                       tcp_keepalive=True,
+                       s3={"payload_signing_enabled": False,
+                           "addressing_style": "virtual"})
+
+try:
+    hashlib.md5(usedforsecurity=False)
+    # lets OpenSSL pick the fastest provider; the MD5 here is an integrity
+    # check, not a security measure
+    MD5_KWARGS = {"usedforsecurity": False}
+except TypeError:  # Python < 3.9
+    MD5_KWARGS = {}
+
 
 class ProgressPercentage:
     """
     Progress percentage printer
+
+    boto3 fires the callback for every transferred chunk, so prints are
+    throttled to roughly ten per second (plus the final one) to keep the
+    callback from spending its time in terminal writes.
     """
 
+    PRINT_INTERVAL = 0.1
+
     def __init__(self, filename, size):
         self._filename = filename
         self._size = size
         self._seen_so_far = 0
         self._lock = threading.Lock()
+        self._last_print = 0.0
+        self._isatty = sys.stdout.isatty()
 
     def __call__(self, bytes_amount):
         with self._lock:
             self._seen_so_far += bytes_amount
+            now = time.monotonic()
+            if (now - self._last_print < self.PRINT_INTERVAL
+                    and self._seen_so_far < self._size):
+                return
+            self._last_print = now
             percentage = round((self._seen_so_far / self._size) * 100, 2)
             sys.stdout.write(f"Downloading {self._filename}: {percentage}% " +
                              "done \r")
-            sys.stdout.flush()
+            if self._isatty:
+                sys.stdout.flush()
 
 
 class S3Handler:
@@ -52,18 +88,32 @@ class S3Handler:
     :ivar verbose: Verbosity level (0-3)
     :ivar temp_download: Path of the location where object from S3 is stored
     :ivar restore_partition_size: Size of partition being restored
+    :ivar restore_gzipped: True if the objects being restored are gzipped
     :ivar split_size: Size in bytes to split tar at
     :ivar gzip: True to compress tar with gzip
     :ivar storage_class: Storage class of S3 object
-    :ivar FIVE_HUNDRED_MB: Five hundred MiB in bytes
-    :ivar FIVE_GB: Five GiB in bytes
+    :ivar max_bandwidth: Transfer cap in bytes per second (None = unlimited)
+    :ivar UPLOAD_PART_SIZE: Preferred size of a single multipart part
+    :ivar MAX_PARTS: Most parts S3 allows in one multipart upload
+    :ivar MAX_UPLOAD_WORKERS: Threads uploading parts concurrently
+    :ivar MAX_BUFFERED_BYTES: In-flight part bytes before reads apply
+        back-pressure
+    :ivar DOWNLOAD_CONFIG: Transfer tuning for restore downloads
+    :ivar DOWNLOAD_RANGE_SIZE: Byte-range size for streamed downloads
+    :ivar DOWNLOAD_WINDOW: Ranges fetched concurrently while streaming
     """
 
-    FIVE_HUNDRED_MB = 500 * (1024 ** 2)
-    FIVE_GB = (5 * (1024 ** 3))
+    UPLOAD_PART_SIZE = 64 * (1024 ** 2)
+    MAX_PARTS = 10000
+    MAX_UPLOAD_WORKERS = 8
+    MAX_BUFFERED_BYTES = 512 * (1024 ** 2)
+    DOWNLOAD_CONFIG = TransferConfig(multipart_chunksize=64 * (1024 ** 2),
+                                     max_concurrency=16)
+    DOWNLOAD_RANGE_SIZE = 64 * (1024 ** 2)
+    DOWNLOAD_WINDOW = 4
 
     def __init__(self, bucket, split_size=5497558138880.0, gzip=False,
-                 storage_class="STANDARD", verbose=0):
+                 storage_class="STANDARD", verbose=0, max_bandwidth=None):
         """
         Initializer for the class attributes.
 
@@ -79,16 +129,24 @@ class S3Handler:
         :type storage_class: string
         :param verbose: Verbosity level (0-3)
         :type verbose: integer
+        :param max_bandwidth: Transfer cap in bytes per second (None for
+            unlimited)
+        :type max_bandwidth: integer
         """
-        self.s3client = boto3.client("s3")
+        self.s3client = boto3.client("s3", config=CLIENT_CONFIG)
         self.bucket = bucket
         self.__check_bucket_accessiblity(bucket)
         self.split_size = split_size
         self.gzip = gzip
         self.storage_class = storage_class
         self.verbose = verbose
+        self.max_bandwidth = max_bandwidth
         self.temp_download = None
         self.restore_partition_size = 0
+        self.restore_gzipped = False
+        self.__last_progress = 0.0
+        self.__throttle_tokens = 0.0
+        self.__throttle_time = time.monotonic()
 
     def __check_bucket_accessiblity(self, bucket):
         """
@@ -125,75 +183,98 @@ class S3Handler:
         :raises Exception: If the objects can't be accessed
         """
         try:
-            response = self.s3client.list_objects_v2(Bucket=self.bucket,
-                                                    Prefix=key)
-            if response["ResponseMetadata"]["HTTPStatusCode"] != 200 or "Contents" not in response:
+            paginator = self.s3client.get_paginator("list_objects_v2")
+            first_key = None
+            object_count = 0
+            total_size = 0
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=key):
+                for s3_object in page.get("Contents", []):
+                    if first_key is None:
+                        first_key = s3_object["Key"]
+                    total_size += int(s3_object["Size"])
+                    object_count += 1
+            if first_key is None:
                 raise Exception
-            objects = list(response["Contents"])
+            self.restore_gzipped = first_key.endswith(".gz")
             response = self.s3client.head_object(Bucket=self.bucket,
-                                                 Key=objects[0]["Key"])
+                                                 Key=first_key)
             partition_size = 0
             if "x-amz-meta-disc-size" in response["Metadata"]:
                 partition_size = int(
                     response["Metadata"]["x-amz-meta-disc-size"])
             if partition_size < 2:
-                partition_size = sum((int(o["Size"]) for o in objects))
+                partition_size = total_size
             self.restore_partition_size = partition_size
-            return len(objects)
+            return object_count
         except Exception as ex:
             print(f"Unable to access key '{key}' in bucket '{self.bucket}'",
                   file=sys.stderr)
             raise ex
 
-    @staticmethod
-    def byte_checksum(data):
+    def __get_key_metadata(self, snapshot, size):
         """
-        Calculate the checksum for the given bytes
+        Generate the base key, metadata and content type for a snapshot
 
-        :param data: Data to calculate checksum for
-        :type data: byte
-
-        :return: The Base64 encoded MD5 checksum
-        :rtype: string
-        """
-        md_obj = hashlib.md5()
-        md_obj.update(data)
-        return base64.b64encode(md_obj.digest()).decode("UTF-8").strip()
-
-    def __get_key_uploadid(self, snapshot, size, partno):
-        """
-        Generate the key and uploadid for a snapshot
+        Computed once per snapshot so every split shares the same sanitized
+        name and upload timestamp; only the part suffix differs (see
+        :func:`__part_key`).
 
         :param snapshot: Snapshot to get the key for
         :type snapshot: dict()
         :param size: Size of mounted partition
         :type size: integer
-        :param partno: Part no of the upload (-1 for single part upload)
-        :type partno: integer
 
-        :return: S3 key and uploadid for the snapshot
-        :rtype: list()
+        :return: Base S3 key, object metadata and content type
+        :rtype: tuple(string, dict(), string)
         """
         meta_data = {}
         content_type = "application/x-tar"
+        if self.gzip:
+            content_type = "application/gzip"
         timestr = datetime.now().isoformat(timespec="seconds")
         created = snapshot["created"].isoformat(timespec="seconds")
         name = snapshot["name"].replace(" ", "+").replace("/", "_")
-        key = f"snap/{name}/{snapshot['id']}-{created}-{timestr}"
+        base_key = f"snap/{name}/{snapshot['id']}-{created}-{timestr}"
         meta_data["creation-time"] = snapshot["created"].isoformat()
         meta_data["snap-volume-size"] = f"{snapshot['volumesize']} GiB"
-        if partno == -1:
-            key = f"{key}.tar"
-            if self.gzip:
-                key = f"{key}.gz"
-                content_type = "application/gzip"
-        else:
-            key = f"{key}-part{partno}.tar"
-            if self.gzip:
-                key = f"{key}.gz"
-                content_type = "application/gzip"
         if size > 1:
             meta_data["x-amz-meta-disc-size"] = str(size)
+        return (base_key, meta_data, content_type)
+
+    def __part_key(self, base_key, partno):
+        """
+        Get the object key for one split of the upload
+
+        :param base_key: Base key of the snapshot
+        :type base_key: string
+        :param partno: Part no of the upload (-1 for single part upload)
+        :type partno: integer
+
+        :return: S3 key of the split
+        :rtype: string
+        """
+        if partno == -1:
+            key = f"{base_key}.tar"
+        else:
+            key = f"{base_key}-part{partno}.tar"
+        if self.gzip:
+            key = f"{key}.gz"
+        return key
+
+    def __create_upload(self, key, meta_data, content_type):
+        """
+        Start a multipart upload for the given key
+
+        :param key: S3 key to upload to
+        :type key: string
+        :param meta_data: Metadata to attach to the object
+        :type meta_data: dict()
+        :param content_type: Content type of the object
+        :type content_type: string
+
+        :return: Uploadid of the new multipart upload
+        :rtype: string
+        """
         res = self.s3client.create_multipart_upload(
             Bucket=self.bucket,
             ContentType=content_type,
@@ -201,7 +282,7 @@ class S3Handler:
             Metadata=meta_data,
             StorageClass=self.storage_class
         )
-        return (key, res["UploadId"])
+        return res["UploadId"]
 
     def initiate_upload(self, snapshot, path, size=0):
         """
@@ -209,19 +290,11 @@ class S3Handler:
 
         1. Initialize the variables
             1. If the upload can be done in one go, set partno as -1
-        2. Get the first key and upload id
-        3. Create a tar process
-        4. Read a chunk (max 5 GB or available RAM size - 50 MB of overhead or
-        remaining size before split occurs)
-            1. Have read enough data for split
-                1. Finish the upload, reset the counters
-                2. If more data to read, get new key and upload id.
-                3. Otherwise break.
-            2. Calculate new chunk size to be read
-            3. Read the chunk, update the counters and get the checksum of the
-                chunk
-            4. Upload part and add returned Etag to list
-        4. Finish the upload
+        2. Create a tar process
+        3. Generate the key and metadata for the current split and upload
+            it (single request or multipart, based on how much data the
+            tar stream yields)
+        4. Repeat with the next part key while the stream has more data
 
         If upload fails in between, abort the upload
 
@@ -244,16 +317,18 @@ class S3Handler:
                              "--preserve-permissions", "."], stdout=PIPE)
         read_process = tar_process
         if self.gzip:
-            gzip_process = Popen(["gzip", "--to-stdout", "-6"],
+            gzip_process = Popen(self.__compress_command(),
                                  stdin=tar_process.stdout, stdout=PIPE)
             read_process = gzip_process
         more_to_read = True
+        (base_key, meta_data, content_type) = self.__get_key_metadata(
+            snapshot, size)
         try:
             while more_to_read:
-                (key, uploadid) = self.__get_key_uploadid(snapshot, size,
-                                                          partno)
+                key = self.__part_key(base_key, partno)
                 (uploaded_bytes, more_to_read) = self.__read_and_upload_part(
-                    read_process, uploaded_bytes, key, uploadid)
+                    read_process, uploaded_bytes, key, meta_data,
+                    content_type)
                 partno += 1
         finally:
             read_process = None
@@ -264,15 +339,36 @@ class S3Handler:
         if self.verbose > 0:
             print("Multipart upload finished. Sending complete")
 
+    @staticmethod
+    def __compress_command():
+        """
+        Get the command to compress the tar stream with
+
+        Single-threaded gzip caps the whole pipeline at one core, so use
+        pigz when it is installed; the output is still a regular gzip
+        stream, keeping the object format and restore path unchanged.
+
+        :return: Compressor command with its arguments
+        :rtype: list(string)
+        """
+        if shutil.which("pigz") is not None:
+            return ["pigz", "--stdout", "-6"]
+        return ["gzip", "--to-stdout", "-6"]
+
     def __read_and_upload_part(self, read_process, uploaded_bytes, key,
-                               upload_id):
+                               meta_data, content_type):
         """
-        Prepare an upload a single part of the tar.
+        Upload a single split of the tar.
 
-        1. Read the data from read_process
-        2. Upload it as multipart upload
-        3. Check if there is more data to be uploaded
-        4. Set the flag and complete the multipart upload
+        1. Read the first part from read_process
+        2. If the stream ended within that part, upload it with one
+            put_object call and skip the multipart machinery entirely
+        3. Otherwise start a multipart upload and keep reading parts,
+            handing each to the upload worker pool (reads pause when too
+            many parts are in flight)
+        4. Collect finished parts and complete the multipart upload
+
+        If upload fails in between, abort the upload
 
         :param read_process: The process to read from
         :type read_process: subprocess.Popen
@@ -280,109 +376,214 @@ class S3Handler:
         :type uploaded_bytes: integer
         :param key: S3 key
         :type key: string
-        :param upload_id: S3 multipart upload id
-        :type upload_id: string
+        :param meta_data: Metadata to attach to the object
+        :type meta_data: dict()
+        :param content_type: Content type of the object
+        :type content_type: string
 
         :return: No of total bytes uploaded, is there more data to process
-        :rtype: dict(integer, boolean)
+        :rtype: tuple(integer, boolean)
         """
         tar_read_bytes = 0
         upload_partid = 1
         parts_info = []
+        pending_parts = []
         more_to_read = True
+        upload_id = None
+        part_size = self.__get_part_size()
+        # bound in-flight memory, not part count: parts grow past 64 MiB
+        # for large split sizes (see __get_part_size), so the window of
+        # buffered copies shrinks to keep their total near
+        # MAX_BUFFERED_BYTES
+        max_buffered = max(2, self.MAX_BUFFERED_BYTES // part_size)
+        buffer = bytearray(part_size)
+        view = memoryview(buffer)
+        read_chunk = int(min(part_size, self.split_size))
+        (nread, content_md5) = self.__read_part(read_process.stdout, view,
+                                                read_chunk)
+        self.__throttle(nread)
+        if nread == 0:
+            # Stream ended exactly at the previous split boundary
+            return (uploaded_bytes, False)
         print(f"Uploading {key} to {self.bucket} bucket")
-        while True:
-            free_mem = psutil.virtual_memory().available
-            if free_mem > self.FIVE_GB: # Maximum part size is 5 GiB
-                free_mem = self.FIVE_GB
-            max_chunk = free_mem - self.FIVE_HUNDRED_MB
-            if tar_read_bytes + max_chunk > self.split_size:
-                read_chunk = self.split_size - tar_read_bytes
-            else:
-                read_chunk = max_chunk
-            try:
-                inline = read_process.stdout.read(read_chunk)
-                if len(inline) == 0:
-                    # No more data to read
-                    more_to_read = False
-                    break
-                tar_read_bytes += len(inline)
-                uploaded_bytes += len(inline)
-                resp = self.__upload_s3_part(inline, key, upload_partid,
-                                             upload_id)
-                del inline
-                parts_info.append({
-                    "ETag": resp["ETag"],
-                    "PartNumber": upload_partid
-                })
-                if self.verbose > 0:
-                    print(f"Part # {upload_partid}, ", end="")
-                print("Uploaded " +
-                      str(round(uploaded_bytes / (1024 ** 2), 2)) +
-                      " MiB (total) ", end="\r")
-                upload_partid += 1
-                gc.collect()
-                if tar_read_bytes >= self.split_size:
-                    # One split upload completed
-                    break
-            except Exception as ex:
-                print("\nMultipart upload failed. Trying to abort",
-                      file=sys.stderr)
-                inline = None # Safely drop the data
+        if nread < read_chunk:
+            # The whole split fits in a single part; one PUT is cheaper
+            # than create/upload/complete round-trips
+            self.s3client.put_object(
+                Body=bytes(view[:nread]),
+                Bucket=self.bucket,
+                ContentMD5=content_md5,
+                ContentType=content_type,
+                Key=key,
+                Metadata=meta_data,
+                StorageClass=self.storage_class
+            )
+            uploaded_bytes += nread
+            print("Uploaded " +
+                  str(round(uploaded_bytes / (1024 ** 2), 2)) +
+                  " MiB (total) ", end="\r")
+            return (uploaded_bytes, False)
+        try:
+            upload_id = self.__create_upload(key, meta_data, content_type)
+            with ThreadPoolExecutor(
+                    max_workers=self.MAX_UPLOAD_WORKERS) as executor:
+                while True:
+                    tar_read_bytes += nread
+                    uploaded_bytes += nread
+                    pending_parts.append(
+                        (executor.submit(self.__upload_s3_part,
+                                         bytes(view[:nread]), content_md5,
+                                         key, upload_partid, upload_id),
+                         upload_partid))
+                    upload_partid += 1
+                    if len(pending_parts) >= max_buffered:
+                        self.__collect_part(pending_parts.pop(0), parts_info,
+                                            uploaded_bytes)
+                    if tar_read_bytes >= self.split_size:
+                        # One split upload completed
+                        break
+                    read_chunk = int(min(part_size,
+                                         self.split_size - tar_read_bytes))
+                    (nread, content_md5) = self.__read_part(
+                        read_process.stdout, view, read_chunk)
+                    self.__throttle(nread)
+                    if nread == 0:
+                        # No more data to read
+                        more_to_read = False
+                        break
+                while len(pending_parts) > 0:
+                    self.__collect_part(pending_parts.pop(0), parts_info,
+                                        uploaded_bytes)
+        except Exception as ex:
+            print("\nMultipart upload failed. Trying to abort",
+                  file=sys.stderr)
+            if upload_id is not None:
                 self.s3client.abort_multipart_upload(
                     Bucket=self.bucket,
                     Key=key,
                     UploadId=upload_id
                 )
-                raise ex
+            raise ex
         self.__complete_upload(key, upload_id, parts_info)
-        return uploaded_bytes, more_to_read
+        return (uploaded_bytes, more_to_read)
+
+    @staticmethod
+    def __read_part(stream, view, limit):
+        """
+        Fill the part buffer from the stream, hashing data as it arrives
+
+        The MD5 is updated while the buffer fills, so the part is traversed
+        only once instead of being re-read for the checksum afterwards.
+
+        :param stream: Stream to read the part from
+        :type stream: file object
+        :param view: Buffer to read the part into
+        :type view: memoryview
+        :param limit: Most bytes to read for this part
+        :type limit: integer
+
+        :return: No of bytes read, Base64 encoded MD5 of those bytes
+        :rtype: tuple(integer, string)
+        """
+        md_obj = hashlib.md5(**MD5_KWARGS)
+        offset = 0
+        while offset < limit:
+            nread = stream.readinto(view[offset:limit])
+            if not nread:
+                break
+            md_obj.update(view[offset:offset + nread])
+            offset += nread
+        return (offset, base64.b64encode(md_obj.digest()).decode("UTF-8"))
+
+    def __get_part_size(self):
+        """
+        Get the part size to use for multipart uploads
+
+        Parts are 64 MiB, the sweet spot for S3 throughput, while keeping
+        buffered memory bounded; the size grows when 10,000 such parts (the
+        S3 limit) would not cover the configured split size.
+
+        :return: Part size in bytes
+        :rtype: integer
+        """
+        return int(max(self.UPLOAD_PART_SIZE,
+                       math.ceil(self.split_size / self.MAX_PARTS)))
+
+    def __collect_part(self, pending_part, parts_info, uploaded_bytes):
+        """
+        Wait for an in-flight part upload and record its ETag
+
+        :param pending_part: Future of the upload and its part number
+        :type pending_part: tuple(concurrent.futures.Future, integer)
+        :param parts_info: List to record the completed part in
+        :type parts_info: list(dict())
+        :param uploaded_bytes: No of bytes read so far (for progress print)
+        :type uploaded_bytes: integer
+        """
+        (future, partid) = pending_part
+        resp = future.result()
+        parts_info.append({
+            "ETag": resp["ETag"],
+            "PartNumber": partid
+        })
+        now = time.monotonic()
+        if now - self.__last_progress < ProgressPercentage.PRINT_INTERVAL:
+            return
+        self.__last_progress = now
+        if self.verbose > 0:
+            print(f"Part # {partid}, ", end="")
+        print("Uploaded " +
+              str(round(uploaded_bytes / (1024 ** 2), 2)) +
+              " MiB (total) ", end="\r")
 
-    def __upload_s3_part(self, body, key, part_id, upload_id, retry_count=0):
+    def __upload_s3_part(self, body, content_md5, key, part_id, upload_id):
         """
         Upload a part of S3 multipart upload.
 
-        The function also reties failed calls. Every upload request, if failed,
-        will be retried 4 times at 4 seconds of intervals.
+        Failed calls are retried up to 3 times with jittered exponential
+        backoff before giving up, so transient errors do not re-fire in
+        lockstep across the upload threads.
 
         :param body: Body of the upload
+        :param content_md5: Base64 encoded MD5 checksum of the body
+        :type content_md5: string
         :param key: S3 object key
         :type key: string
         :param part_id: Upload part ID
         :type part_id: int
         :param upload_id: Multipart upload's Upload ID
         :type upload_id: string
-        :param retry_count: How many retries have been done.
-        :type retry_count: int
 
         :return: Response from S3
 
         :raises Exception: If all upload attempt fails
         """
-        if retry_count > 3:
-            raise Exception("S3 multipart part upload failed")
-        try:
-            return self.s3client.upload_part(
-                Body=body,
-                Bucket=self.bucket,
-                ContentMD5=S3Handler.byte_checksum(body),
-                Key=key,
-                PartNumber=part_id,
-                UploadId=upload_id
-            )
-        except ClientError as error:
-            print(f"Failed: '{error.response['Error']['Message']}'.\nRetrying.",
-                  file=sys.stderr)
-            time.sleep(4.0)
-            return self.__upload_s3_part(body, key, part_id, upload_id,
-                                         retry_count + 1)
+        last_error = None
+        for attempt in range(4):
+            try:
+                return self.s3client.upload_part(
+                    Body=body,
+                    Bucket=self.bucket,
+                    ContentMD5=content_md5,
+                    Key=key,
+                    PartNumber=part_id,
+                    UploadId=upload_id
+                )
+            except ClientError as error:
+                print(f"Failed: '{error.response['Error']['Message']}'.",
+                      file=sys.stderr)
+                last_error = error
+            if attempt < 3:
+                print("Retrying.", file=sys.stderr)
+                time.sleep(self.__backoff_delay(attempt))
+        raise Exception("S3 multipart part upload failed") from last_error
 
-    def __complete_upload(self, key, uploadid, partlist, retry_count=0):
+    def __complete_upload(self, key, uploadid, partlist):
         """
         Complete a multipart upload
 
-        The function also reties failed calls. Every upload request, if failed,
-        will be retried 4 times at 4 seconds of intervals.
+        Failed calls are retried up to 3 times with jittered exponential
+        backoff; if the last attempt fails too the upload is aborted.
 
         :param key: Key of the upload
         :type key: string
@@ -393,32 +594,76 @@ class S3Handler:
 
         :raises Exception: If all upload attempt fails, abort uploads.
         """
-        if retry_count > 3:
-            print("\nMultipart upload failed. Trying to abort",
-                  file=sys.stderr)
-            self.s3client.abort_multipart_upload(
-                Bucket=self.bucket,
-                Key=key,
-                UploadId=uploadid
-            )
-            raise Exception("S3 upload failed")
-        try:
-            self.s3client.complete_multipart_upload(
-                Bucket=self.bucket,
-                Key=key,
-                MultipartUpload={
-                    "Parts": partlist
-                },
-                UploadId=uploadid
-            )
-        except ClientError as error:
-            print(f"Failed: '{error.response['Error']['Message']}'.\nRetrying.",
-                  file=sys.stderr)
-            time.sleep(4.0)
-            self.__complete_upload(key, uploadid, partlist, retry_count + 1)
+        for attempt in range(4):
+            try:
+                self.s3client.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=key,
+                    MultipartUpload={
+                        "Parts": partlist
+                    },
+                    UploadId=uploadid
+                )
+                break
+            except ClientError as error:
+                print(f"Failed: '{error.response['Error']['Message']}'.",
+                      file=sys.stderr)
+                if attempt == 3:
+                    print("\nMultipart upload failed. Trying to abort",
+                          file=sys.stderr)
+                    self.s3client.abort_multipart_upload(
+                        Bucket=self.bucket,
+                        Key=key,
+                        UploadId=uploadid
+                    )
+                    raise Exception("S3 upload failed") from error
+                print("Retrying.", file=sys.stderr)
+                time.sleep(self.__backoff_delay(attempt))
         if self.verbose > 0:
             print(f"\nCompleted multipart upload, key: {key}")
 
+    @staticmethod
+    def __backoff_delay(attempt):
+        """
+        Delay to sleep before the next retry attempt
+
+        Exponential in the number of attempts with random jitter, capped at
+        30 seconds, so parallel part uploads hitting a transient error do
+        not hammer S3 again at the same moment.
+
+        :param attempt: Zero-based count of attempts made so far
+        :type attempt: integer
+
+        :return: Seconds to sleep
+        :rtype: float
+        """
+        return min(30.0, 2.0 * (2 ** attempt)) + random.uniform(0.0, 0.5)
+
+    def __throttle(self, nbytes):
+        """
+        Pace transfers to the configured bandwidth cap
+
+        Token bucket refilled at ``max_bandwidth`` bytes per second with a
+        one second burst allowance; the caller sleeps off any deficit. A
+        no-op when no cap is configured. Called from the single-threaded
+        read and write loops, so the pacing covers the parallel part
+        uploads and ranged downloads they feed.
+
+        :param nbytes: Bytes just read or written
+        :type nbytes: integer
+        """
+        if not self.max_bandwidth:
+            return
+        now = time.monotonic()
+        self.__throttle_tokens = min(
+            float(self.max_bandwidth),
+            self.__throttle_tokens +
+            (now - self.__throttle_time) * self.max_bandwidth)
+        self.__throttle_time = now
+        self.__throttle_tokens -= nbytes
+        if self.__throttle_tokens < 0:
+            time.sleep(-self.__throttle_tokens / self.max_bandwidth)
+
     def get_object_count_and_size(self, key):
         """
         Check if the given key is available and return number of objects under
@@ -434,6 +679,17 @@ class S3Handler:
         return (self.__get_object_count(key),
                 self.restore_partition_size)
 
+    def is_restore_gzipped(self):
+        """
+        Check if the objects being restored are gzip compressed
+
+        Valid only after a call to :func:`get_object_count_and_size`.
+
+        :return: True if the restore objects are gzipped
+        :rtype: boolean
+        """
+        return self.restore_gzipped
+
     def download_key(self, key, partno, restore_dir):
         """
         Download the key from S3
@@ -454,27 +710,21 @@ class S3Handler:
 
         :raises Exception: If download fails, delete the temp location
         """
-        response = self.s3client.list_objects_v2(Bucket=self.bucket,
-                                                 Prefix=key)
-        keys = [o["Key"] for o in response["Contents"]]
-        download_key_name = None
-        if partno == -1:
-            download_key_name = keys[0]
-        else:
-            for dkey in keys:
-                if f"-part{partno}.tar" in dkey:
-                    download_key_name = dkey
-                    break
-        if download_key_name is None:
-            raise Exception(f"Unable to find part '{partno}' under key {key}")
+        download_key_name = self.__get_download_key_name(key, partno)
         self.temp_download = os.path.join(restore_dir, download_key_name)
         os.makedirs(os.path.dirname(self.temp_download), exist_ok=True)
         size = self.s3client.head_object(Bucket=self.bucket,
                                          Key=download_key_name)["ContentLength"]
         progress = ProgressPercentage(key, size)
         try:
-            self.s3client.download_file(self.bucket, download_key_name,
-                                        self.temp_download, Callback=progress)
+            with open(self.temp_download, "wb") as fileobj:
+                if size > 0:
+                    # pre-size the file so the concurrent ranged writes do
+                    # not fight delayed allocation and fragment it
+                    os.posix_fallocate(fileobj.fileno(), 0, size)
+                self.s3client.download_fileobj(
+                    self.bucket, download_key_name, fileobj,
+                    Callback=progress, Config=self.DOWNLOAD_CONFIG)
             print()
         except Exception as ex:
             print(f"Failed while downloading s3://{self.bucket}/{download_key_name}",
@@ -482,3 +732,98 @@ class S3Handler:
             os.remove(self.temp_download)
             raise ex
         return self.temp_download
+
+    def __get_download_key_name(self, key, partno):
+        """
+        Resolve the actual object key for the given part number
+
+        :param key: Key prefix to look under
+        :type key: string
+        :param partno: Part number of the key (-1 if there is only one part)
+        :type partno: integer
+
+        :return: Name of the S3 object to download
+        :rtype: string
+
+        :raises Exception: If the part can't be found under the key
+        """
+        paginator = self.s3client.get_paginator("list_objects_v2")
+        download_key_name = None
+        part_marker = f"-part{partno}.tar"
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=key):
+            for s3_object in page.get("Contents", []):
+                dkey = s3_object["Key"]
+                if partno == -1 or part_marker in dkey:
+                    download_key_name = dkey
+                    break
+            if download_key_name is not None:
+                break
+        if download_key_name is None:
+            raise Exception(f"Unable to find part '{partno}' under key {key}")
+        return download_key_name
+
+    def download_key_streaming(self, key, partno, fileobj):
+        """
+        Stream the key from S3 directly into the given file object
+
+        Unlike :func:`download_key`, the object is never staged on the local
+        disk. It is fetched as byte ranges, a few of which download
+        concurrently while completed ranges are written into ``fileobj``
+        (typically the stdin pipe of the untar process) in order, so the
+        pipe stays fed at parallel download speed even though it needs
+        sequential writes.
+
+        :param key: Key to be downloaded
+        :type key: string
+        :param partno: Part number of the key to be downloaded (-1 if there is
+            only one part)
+        :type partno: integer
+        :param fileobj: Writable file object to stream the object into
+        :type fileobj: file object
+
+        :raises Exception: If download fails
+        """
+        download_key_name = self.__get_download_key_name(key, partno)
+        size = self.s3client.head_object(Bucket=self.bucket,
+                                         Key=download_key_name)["ContentLength"]
+        progress = ProgressPercentage(key, size)
+        pending_ranges = []
+        offset = 0
+        try:
+            with ThreadPoolExecutor(
+                    max_workers=self.DOWNLOAD_WINDOW) as executor:
+                while offset < size or len(pending_ranges) > 0:
+                    while (offset < size and
+                           len(pending_ranges) < self.DOWNLOAD_WINDOW):
+                        end = min(offset + self.DOWNLOAD_RANGE_SIZE, size) - 1
+                        pending_ranges.append(
+                            executor.submit(self.__download_range,
+                                            download_key_name, offset, end))
+                        offset = end + 1
+                    data = pending_ranges.pop(0).result()
+                    fileobj.write(data)
+                    progress(len(data))
+                    self.__throttle(len(data))
+            print()
+        except Exception as ex:
+            print(f"Failed while streaming s3://{self.bucket}/{download_key_name}",
+                  file=sys.stderr)
+            raise ex
+
+    def __download_range(self, key, start, end):
+        """
+        Fetch a single byte range of an object
+
+        :param key: Key of the object to fetch from
+        :type key: string
+        :param start: First byte of the range
+        :type start: integer
+        :param end: Last byte of the range (inclusive)
+        :type end: integer
+
+        :return: Data of the range
+        :rtype: bytes
+        """
+        response = self.s3client.get_object(Bucket=self.bucket, Key=key,
+                                            Range=f"bytes={start}-{end}")
+        return response["Body"].read()
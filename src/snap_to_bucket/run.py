@@ -11,12 +11,14 @@ __author__ = "Siemens AG"
 import os
 import re
 import sys
-import math
+from decimal import Decimal, ROUND_CEILING
 
 import click
-from pkg_resources import get_distribution
 
-from snap_to_bucket.runner import SnapToBucket
+SPLIT_PATTERN = re.compile(r"^([\d.]+)(b|k|m|g|t)$")
+SPLIT_SCALES = {"b": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+MAX_SPLIT_BYTES = 5 * (1 << 40)
+MIN_SPLIT_BYTES = 5 * (1 << 20)
 
 
 class VolSize(click.ParamType):
@@ -30,22 +32,10 @@ class VolSize(click.ParamType):
         Function to parse the split argument
         """
         if isinstance(value, str):
-            match_result = re.match(r"""^([\d\.]+)(b|k|m|g|t)$""", value,
-                                    re.RegexFlag.IGNORECASE | re.RegexFlag.MULTILINE)
+            match_result = SPLIT_PATTERN.match(value.strip().lower())
             if match_result:
-                size = match_result.group(1)
-                split_bytes = 0
-                if match_result.group(2) == "b":
-                    split_bytes = float(size)
-                elif match_result.group(2) == "k":
-                    split_bytes = float(size) * 1024.0
-                elif match_result.group(2) == "m":
-                    split_bytes = float(size) * 1024.0 * 1024.0
-                elif match_result.group(2) == "g":
-                    split_bytes = float(size) * 1024.0 * 1024.0 * 1024.0
-                elif match_result.group(2) == "t":
-                    split_bytes = float(size) * 1024.0 * \
-                        1024.0 * 1024.0 * 1024.0
+                (size, suffix) = match_result.group(1, 2)
+                split_bytes = Decimal(size) * SPLIT_SCALES[suffix]
             else:
                 self.fail(
                     f"{value} not in <size><b|k|m|g|t> format",
@@ -53,24 +43,36 @@ class VolSize(click.ParamType):
                     ctx,
                 )
         else:
-            split_bytes = float(value)
-        if split_bytes > 5497558138880.0:
+            split_bytes = Decimal(value)
+        split_bytes = int(split_bytes.to_integral_value(rounding=ROUND_CEILING))
+        if split_bytes > MAX_SPLIT_BYTES:
             self.fail(
                 f"Can not have spit size greater than 5t, {value} provided",
                 param,
                 ctx,
             )
-        if split_bytes < 5242880.0:
+        if split_bytes < MIN_SPLIT_BYTES:
             self.fail(
                 f"Can not have spit size lesser than 5m, {value} provided",
                 param,
                 ctx,
             )
-        return int(math.ceil(split_bytes))
+        return split_bytes
+
+
+VOLUME_TYPES = ("standard", "io1", "io2", "gp2", "gp3", "sc1", "st1")
+STORAGE_CLASSES = ("STANDARD", "REDUCED_REDUNDANCY", "STANDARD_IA",
+                   "ONEZONE_IA", "GLACIER", "INTELLIGENT_TIERING",
+                   "DEEP_ARCHIVE")
+VOLUME_TYPE_CHOICE = click.Choice(VOLUME_TYPES, case_sensitive=False)
+STORAGE_CLASS_CHOICE = click.Choice(STORAGE_CLASSES, case_sensitive=False)
+DIR_PATH = click.Path(exists=False, dir_okay=True, writable=True,
+                      file_okay=False, resolve_path=True)
+SPLIT_SIZE = VolSize()
 
 
 @click.command(context_settings=dict(help_option_names=["-h", "--help"]))
-@click.version_option(get_distribution("snap_to_bucket").version)
+@click.version_option(package_name="snap_to_bucket")
 @click.option("-v", "--verbose", help="increase output verbosity (-vvv for " +
               "more verbosity)", count=True, default=0)
 @click.option("--proxy", help="proxy to be used", default=None,
@@ -83,29 +85,24 @@ class VolSize(click.ParamType):
 @click.option("-t", "--tag", help="tag on snapshots", default="snap-to-bucket",
               show_default=True, metavar="TAG")
 @click.option("--type", help="volume type", default="gp2", show_default=True,
-              type=click.Choice(
-                    ["standard", "io1", "io2", "gp2", "gp3", "sc1", "st1"],
-                    case_sensitive=False))
+              type=VOLUME_TYPE_CHOICE)
 @click.option("--iops", help="volume IOPS, valid only for gp3, io1 and io2",
               default=None, type=click.INT, required=False)
 @click.option("--throughput", help="volume throughput in MiB/s. Valid only " +
               "for gp3 volumes", default=None, metavar="THROUGHPUT",
               type=click.IntRange(125, 1000, clamp=True))
+@click.option("--max-bandwidth", help="cap S3 transfer bandwidth in MiB/s",
+              default=None, metavar="BANDWIDTH", type=click.IntRange(min=1))
 @click.option("--storage-class", help="storage class for S3 objects",
               default="STANDARD", show_default=True,
-              type=click.Choice(["STANDARD", "REDUCED_REDUNDANCY",
-                                 "STANDARD_IA", "ONEZONE_IA", "GLACIER",
-                                 "INTELLIGENT_TIERING", "DEEP_ARCHIVE"],
-                                case_sensitive=False))
+              type=STORAGE_CLASS_CHOICE)
 @click.option("-m", "--mount", help="mount point for disks", metavar="DIR",
-              default="/mnt/snaps", show_default=True,
-              type=click.Path(exists=False, dir_okay=True, writable=True,
-                              file_okay=False, resolve_path=True))
+              default="/mnt/snaps", show_default=True, type=DIR_PATH)
 @click.option("-d", "--delete", help="delete snapshot after transfer. Use " +
               "with caution!", is_flag=True, default=False, show_default=True)
 @click.option("-s", "--split", help="split tar in chunks no bigger than " +
               "(allowed suffix b,k,m,g,t)  [default: 5t]", metavar="SIZE",
-              default="5t", type=VolSize())
+              default="5t", type=SPLIT_SIZE)
 @click.option("-g", "--gzip", help="compress tar with gzip", is_flag=True,
               default=False)
 @click.option("-r", "--restore", help="restore a snapshot", is_flag=True,
@@ -116,15 +113,19 @@ class VolSize(click.ParamType):
               is_flag=True, default=False)
 @click.option("--restore-dir", help="directory to store S3 objects for " +
               "restoring", default="/tmp/snap-to-bucket", show_default=True,
-              type=click.Path(exists=False, dir_okay=True, writable=True,
-                              file_okay=False, resolve_path=True))
+              type=DIR_PATH)
 def main(verbose, proxy, noproxy, bucket, tag, type, storage_class, mount,
          delete, split, gzip, restore, key, boot, restore_dir, iops,
-         throughput):
+         throughput, max_bandwidth):
     """
     snap2bucket is a simple tool based on boto3 to move snapshots to S3
     buckets.
     """
+    if os.geteuid() != 0:
+        click.echo("You need to have root privileges to run this script.\n" +
+                   "Please try again, this time using 'sudo'. Exiting.",
+                   err=True)
+        sys.exit(5)
     if type not in ["gp3", "io1", "io2"] and iops is not None:
         raise click.BadOptionUsage("iops", "Can set IOPS only for gp3, io1 &" +
                                    f" io2 type volume, {type} set")
@@ -138,11 +139,8 @@ def main(verbose, proxy, noproxy, bucket, tag, type, storage_class, mount,
     if type != "gp3" and throughput is not None:
         raise click.BadOptionUsage("throughput", "Only gp3 supports " +
                                    f"throughput, {type} passed")
-    if os.geteuid() != 0:
-        click.echo("You need to have root privileges to run this script.\n" +
-                   "Please try again, this time using 'sudo'. Exiting.",
-                   err=True)
-        sys.exit(5)
+    # deferred so --help/--version and bad invocations skip the boto3 import
+    from snap_to_bucket.runner import SnapToBucket  # pylint: disable=import-outside-toplevel
     snap_to_bucket = SnapToBucket(bucket, tag, verbose, type, storage_class,
                                   mount, delete, restore, key, boot,
                                   restore_dir)
@@ -150,6 +148,8 @@ def main(verbose, proxy, noproxy, bucket, tag, type, storage_class, mount,
         snap_to_bucket.update_iops(iops)
     if throughput is not None:
         snap_to_bucket.update_throughput(throughput)
+    if max_bandwidth is not None:
+        snap_to_bucket.update_max_bandwidth(max_bandwidth)
     snap_to_bucket.update_proxy(proxy, noproxy)
     snap_to_bucket.update_split_size(split)
     if gzip:
@@ -10,6 +10,7 @@ __author__ = "Siemens AG"
 
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 from snap_to_bucket.handlers import Ec2Handler
 from snap_to_bucket.handlers import S3Handler
@@ -35,6 +36,7 @@ class SnapToBucket:
     :ivar restore_dir: Location to store S3 object for restore
     :ivar iops: IOPS for supported volumes
     :ivar throughput: Throughput for supported volumes
+    :ivar max_bandwidth: S3 transfer cap in bytes per second
     """
 
     def __init__(self, bucket, tag="snap-to-bucket", verbose=0,
@@ -91,9 +93,11 @@ class SnapToBucket:
         self.__gzip = False
         self.__iops = None
         self.__throughput = None
+        self.__max_bandwidth = None
         self.__ec2handler = None
         self.__s3handler = None
         self.__fshandler = None
+        self.__attach_devices = ["/dev/sdk", "/dev/sdl"]
 
     @staticmethod
     def update_proxy(proxy=None, noproxy=None):
@@ -150,6 +154,15 @@ class SnapToBucket:
         """
         self.__throughput = int(throughput)
 
+    def update_max_bandwidth(self, max_bandwidth):
+        """
+        Update the S3 transfer bandwidth cap
+
+        :param max_bandwidth: New bandwidth cap in MiB/s
+        :type max_bandwidth: int
+        """
+        self.__max_bandwidth = int(max_bandwidth) * (1024 ** 2)
+
     def initiate_migration(self):
         """
         The brains of the process
@@ -159,7 +172,7 @@ class SnapToBucket:
                                        self.__throughput)
         self.__s3handler = S3Handler(self.__bucket, self.__split_size,
                                      self.__gzip, self.__storage_class,
-                                     self.__verbose)
+                                     self.__verbose, self.__max_bandwidth)
         self.__fshandler = FsHandler(self.__mount_point, self.__verbose)
         os.makedirs(self.__mount_point, exist_ok=True)
         if self.__restore is True:
@@ -172,39 +185,58 @@ class SnapToBucket:
             return
 
         snapshots = self.__ec2handler.get_snapshots()
-        if len(snapshots) < 1:
+        total = len(snapshots)
+        if total < 1:
             print(f"Unable to find snapshots with tag:{self.__tag}, value:migrate")
             return
 
         i = 1
-        for snapshot in snapshots:
-            print(f"Processing snapshot '{snapshot['id']}'")
-            volumeid = self.__create_attach_volume(snapshot)
-            try:
-                self.__fshandler.mount_volume(volumeid)
-                size = self.__fshandler.get_mounted_disc_size()
-                self.__move_data(snapshot, size)
-            except Exception as ex:
-                print("Error occurred during S3 upload for snapshot '" +
-                      snapshot["id"] + "'", file=sys.stderr)
-                print(f"Deleting volume '{volumeid}'", file=sys.stderr)
-                raise ex
-            finally:
-                self.__fshandler.unmount_volume()
-                self.__ec2handler.detach_volume(volumeid)
-                self.__ec2handler.delete_volume(volumeid)
-            if self.__delete_snap:
-                self.__ec2handler.delete_snapshot(snapshot)
-            else:
-                self.__ec2handler.update_snapshot_tag(snapshot)
-            print(f"Processed snapshot '{snapshot['id']}'")
-            print(f"{i} of " + str(len(snapshots)))
-            i = i + 1
+        with ThreadPoolExecutor(max_workers=1) as prefetcher:
+            volume_future = prefetcher.submit(self.__create_attach_volume,
+                                              snapshots[0])
+            for snapshot in snapshots:
+                print(f"Processing snapshot '{snapshot['id']}'")
+                volumeid = volume_future.result()
+                if i < total:
+                    # EBS create/attach of the next snapshot overlaps with
+                    # the S3 upload of the current one
+                    volume_future = prefetcher.submit(
+                        self.__create_attach_volume, snapshots[i])
+                else:
+                    volume_future = None
+                try:
+                    self.__fshandler.mount_volume(volumeid)
+                    size = self.__fshandler.get_mounted_disc_size()
+                    self.__move_data(snapshot, size)
+                except Exception as ex:
+                    print("Error occurred during S3 upload for snapshot '" +
+                          snapshot["id"] + "'", file=sys.stderr)
+                    print(f"Deleting volume '{volumeid}'", file=sys.stderr)
+                    self.__discard_prefetched_volume(volume_future)
+                    raise ex
+                finally:
+                    self.__fshandler.unmount_volume()
+                    # Teardown happens behind the single worker: it is
+                    # queued after the next volume's create/attach and
+                    # before the one after that, so the alternate device
+                    # name is always free again before it is reused. The
+                    # executor shutdown waits for the last teardown.
+                    prefetcher.submit(self.__teardown_volume, volumeid)
+                if self.__delete_snap:
+                    self.__ec2handler.delete_snapshot(snapshot)
+                else:
+                    self.__ec2handler.update_snapshot_tag(snapshot)
+                print(f"Processed snapshot '{snapshot['id']}'")
+                print(f"{i} of {total}")
+                i = i + 1
 
     def __create_attach_volume(self, snap):
         """
         Create and attach a new volume from given snapshot
 
+        Two volumes can be attached at the same time (the one being uploaded
+        and the prefetched one), so the attachment device name alternates.
+
         :param snap: Snapshot to be mounted
         :type snap: dict()
 
@@ -212,9 +244,47 @@ class SnapToBucket:
         :rtype: str
         """
         volumeid = self.__ec2handler.create_volume(snap)
-        self.__ec2handler.attach_volume(volumeid)
+        device = self.__attach_devices[0]
+        self.__attach_devices.reverse()
+        self.__ec2handler.attach_volume(volumeid, device)
         return volumeid
 
+    def __teardown_volume(self, volumeid):
+        """
+        Detach and delete a volume whose upload has finished
+
+        Runs on the prefetcher thread so the EBS state transitions do not
+        hold up the next snapshot. Failures are reported instead of raised
+        since nobody waits on the result.
+
+        :param volumeid: Volume to tear down
+        :type volumeid: str
+        """
+        try:
+            self.__ec2handler.detach_volume(volumeid)
+            self.__ec2handler.delete_volume(volumeid)
+        except Exception:  # pylint: disable=broad-except
+            print(f"Unable to clean up volume '{volumeid}'", file=sys.stderr)
+
+    def __discard_prefetched_volume(self, volume_future):
+        """
+        Detach and delete a volume which was attached ahead of time
+
+        Called when the migration loop fails so the prefetched volume for the
+        next snapshot does not leak.
+
+        :param volume_future: Pending result of __create_attach_volume
+        :type volume_future: concurrent.futures.Future
+        """
+        if volume_future is None:
+            return
+        try:
+            volumeid = volume_future.result()
+            self.__ec2handler.detach_volume(volumeid)
+            self.__ec2handler.delete_volume(volumeid)
+        except Exception:  # pylint: disable=broad-except
+            print("Unable to clean up the prefetched volume", file=sys.stderr)
+
     def __move_data(self, snapshot, size=0):
         """
         Upload the data from snapshot to S3
@@ -242,10 +312,11 @@ class SnapToBucket:
                                                         -1, self.__restore_dir)
                 self.__fshandler.untar_single_file(temp_path)
             else:
+                gzipped = self.__s3handler.is_restore_gzipped()
                 for i in range(1, no_of_objects + 1):
-                    temp_path = self.__s3handler.download_key(
-                        self.__restore_key, i, self.__restore_dir)
-                    self.__fshandler.untar(temp_path)
+                    self.__s3handler.download_key_streaming(
+                        self.__restore_key, i,
+                        self.__fshandler.get_untar_stream(gzipped))
             self.__fshandler.terminate_tar()
             if self.__restore_boot:
                 self.__fshandler.update_fstab()